@@ -15,20 +15,33 @@ Výstup:
   outputs/HubSpot_Deals_By_Stage_2026.xlsx
 """
 
+import json
 import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font
+import pandas as pd
 
 try:
     from zoneinfo import ZoneInfo  # Python 3.9+
 except ImportError:
     from backports.zoneinfo import ZoneInfo
 
+try:
+    import orjson  # rychlejší parsování velkých JSON odpovědí (deals search)
+except ImportError:
+    orjson = None
+
 
 # ===== Konfigurace =====
 BASE_DIR = Path("outputs")
@@ -37,6 +50,19 @@ EXCEL_PATH = BASE_DIR / "HubSpot_Deals_By_Stage_2026.xlsx"
 CUTOFF_DATE_ISO = "2027-01-01T00:00:00Z"
 LOCAL_TZ = "Europe/Prague"
 DEBUG_MAX_PAGES = None  # např. 2 při ladění
+MAX_RETRIES = 8  # 429/5xx pokusy na jeden request, pak raise_for_status
+SEARCH_PAGE_SIZE = 100
+OWNERS_PAGE_SIZE = 500  # max. pro /crm/v3/owners; kurzor nejde paralelizovat, tak aspoň méně stránek
+SEARCH_WORKERS = 4  # souběžné stránky deals search (HubSpot limit ~5 req/s)
+
+# Pipelines/owners se mění zřídka -> lokální cache s TTL (ušetří request za běh)
+PIPELINES_CACHE = BASE_DIR / ".pipelines_cache.json"
+PIPELINES_CACHE_TTL = 7 * 86400
+OWNERS_CACHE = BASE_DIR / ".owners_cache.json"
+OWNERS_CACHE_TTL = 86400
+
+HEADER_FONT = Font(bold=True)
+AMOUNT_FORMAT = "#,##0"
 
 
 # ===== Pomocné funkce =====
@@ -55,13 +81,32 @@ def hs_headers(token: str) -> Dict[str, str]:
     return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
 
 
+def make_session(token: str) -> requests.Session:
+    """
+    Jedna session pro celý běh – stránky se posílají přes stejné keep-alive
+    spojení k api.hubapi.com (bez nového TCP+TLS handshaku na každý request).
+    Retry řešíme sami (backoff_sleep), proto max_retries=0.
+    """
+    session = requests.Session()
+    session.headers.update(hs_headers(token))
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=10, max_retries=Retry(total=0))
+    session.mount("https://", adapter)
+    return session
+
+
 def iso_to_epoch_ms(iso_str: str) -> int:
     dt = datetime.fromisoformat(iso_str.replace("Z", "+00:00"))
     return int(dt.timestamp() * 1000)
 
 
-def backoff_sleep(attempt: int):
-    time.sleep(min(2 ** attempt, 32))
+def backoff_sleep(attempt: int, resp: Optional[requests.Response] = None):
+    # HubSpot při 429 posílá Retry-After (sekundy) – ten má přednost před 2**attempt.
+    # Jitter, aby souběžné requesty nezkoušely znovu všechny ve stejnou chvíli.
+    try:
+        delay = float(resp.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        delay = min(2 ** attempt, 32)
+    time.sleep(delay + random.uniform(0, 1.0))
 
 
 def env_bool(name: str, default: bool = False) -> bool:
@@ -76,7 +121,7 @@ def make_unique_week_label(existing_headers: List[str], base_label: str) -> str:
     Pokud base_label už existuje v headeru, vytvoří base_label + ' #2', '#3', ...
     Používá se jen když ALLOW_DUPLICATE_WEEK_COLUMNS=true.
     """
-    existing = [h for h in existing_headers if h]
+    existing = {h for h in existing_headers if h}
     if base_label not in existing:
         return base_label
 
@@ -86,20 +131,56 @@ def make_unique_week_label(existing_headers: List[str], base_label: str) -> str:
     return f"{base_label} #{i}"
 
 
+def read_json_cache(path: Path, ttl_seconds: int) -> Optional[dict]:
+    """Vrátí obsah cache souboru, pokud existuje a je mladší než ttl_seconds."""
+    try:
+        if time.time() - path.stat().st_mtime >= ttl_seconds:
+            return None
+        with path.open(encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def write_json_cache(path: Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
 # ===== HubSpot API =====
-def get_all_owners(token: str) -> Dict[str, str]:
-    url = "https://api.hubapi.com/crm/v3/owners/"
-    owners_map: Dict[str, str] = {}
-    params = {"limit": 100, "archived": "false"}
+def _json(resp: requests.Response) -> dict:
+    if orjson is not None:
+        return orjson.loads(resp.content)
+    return resp.json()
+
+
+def hs_request(session: requests.Session, method: str, url: str, **kwargs) -> dict:
     attempt = 0
     while True:
-        resp = requests.get(url, headers=hs_headers(token), params=params)
-        if resp.status_code == 429 or 500 <= resp.status_code < 600:
+        resp = session.request(method, url, **kwargs)
+        retryable = resp.status_code == 429 or 500 <= resp.status_code < 600
+        if retryable and attempt < MAX_RETRIES:
             attempt += 1
-            backoff_sleep(attempt)
+            backoff_sleep(attempt, resp)
             continue
         resp.raise_for_status()
-        data = resp.json()
+        return _json(resp)
+
+
+def get_all_owners(session: requests.Session) -> Dict[str, str]:
+    url = "https://api.hubapi.com/crm/v3/owners/"
+    cached = read_json_cache(OWNERS_CACHE, OWNERS_CACHE_TTL)
+    if cached is not None and all(isinstance(v, str) for v in cached.values()):
+        return cached
+
+    owners_map: Dict[str, str] = {}
+    params = {"limit": OWNERS_PAGE_SIZE, "archived": "false"}
+    while True:
+        data = hs_request(session, "GET", url, params=params)
         for o in data.get("results", []):
             owner_id = str(o.get("id"))
             name = (
@@ -112,21 +193,17 @@ def get_all_owners(token: str) -> Dict[str, str]:
             params["after"] = next_after
         else:
             break
+    write_json_cache(OWNERS_CACHE, owners_map)
     return owners_map
 
 
-def get_stage_label_map(token: str) -> Tuple[Dict[str, str], List[str]]:
+def get_stage_label_map(session: requests.Session) -> Tuple[Dict[str, str], List[str]]:
+    cached = read_json_cache(PIPELINES_CACHE, PIPELINES_CACHE_TTL)
+    if cached is not None and "labels" in cached and "order" in cached:
+        return cached["labels"], cached["order"]
+
     url = "https://api.hubapi.com/crm/v3/pipelines/deals"
-    attempt = 0
-    while True:
-        resp = requests.get(url, headers=hs_headers(token))
-        if resp.status_code == 429 or 500 <= resp.status_code < 600:
-            attempt += 1
-            backoff_sleep(attempt)
-            continue
-        resp.raise_for_status()
-        data = resp.json()
-        break
+    data = hs_request(session, "GET", url)
     stage_label_map: Dict[str, str] = {}
     default_order: List[str] = []
     for pipe in data.get("results", []):
@@ -135,10 +212,16 @@ def get_stage_label_map(token: str) -> Tuple[Dict[str, str], List[str]]:
             default_order = [s.get("label", s.get("id")) for s in stages]
         for s in stages:
             stage_label_map[s.get("id")] = s.get("label", s.get("id"))
+    write_json_cache(PIPELINES_CACHE, {"labels": stage_label_map, "order": default_order})
     return stage_label_map, default_order
 
 
-def fetch_deals(token: str, cutoff_epoch_ms: int) -> List[dict]:
+def iter_deal_pages(session: requests.Session, cutoff_epoch_ms: int) -> Iterator[List[dict]]:
+    """
+    Search API vrací v první stránce 'total' a 'after' je jen offset, takže
+    zbylé stránky se dají stáhnout paralelně (SEARCH_WORKERS najednou)
+    místo čekání na kurzor z předchozí stránky.
+    """
     url = "https://api.hubapi.com/crm/v3/objects/deals/search"
     body = {
         "filterGroups": [
@@ -152,68 +235,66 @@ def fetch_deals(token: str, cutoff_epoch_ms: int) -> List[dict]:
                 ]
             }
         ],
-        "properties": ["dealstage", "amount", "hubspot_owner_id", "closedate", "pipeline"],
-        "limit": 100,
+        # jen to, co čte agregace (řazení podle closedate funguje i bez ní v properties)
+        "properties": ["dealstage", "amount", "hubspot_owner_id"],
+        "limit": SEARCH_PAGE_SIZE,
         "sorts": [{"propertyName": "closedate", "direction": "DESCENDING"}],
     }
 
-    all_deals: List[dict] = []
-    pages = 0
-    after = None
-    attempt = 0
+    first = hs_request(session, "POST", url, json=body)
+    yield first.get("results", [])
 
-    while True:
-        if after:
-            body["after"] = after
+    total = int(first.get("total") or 0)
+    offsets = list(range(SEARCH_PAGE_SIZE, total, SEARCH_PAGE_SIZE))
+    if DEBUG_MAX_PAGES:
+        offsets = offsets[: DEBUG_MAX_PAGES - 1]
 
-        resp = requests.post(url, headers=hs_headers(token), json=body)
-        if resp.status_code == 429 or 500 <= resp.status_code < 600:
-            attempt += 1
-            backoff_sleep(attempt)
-            continue
+    def fetch_page(offset: int) -> List[dict]:
+        data = hs_request(session, "POST", url, json={**body, "after": str(offset)})
+        return data.get("results", [])
 
-        resp.raise_for_status()
-        data = resp.json()
-        attempt = 0
+    # map() vrací stránky ve stejném pořadí, v jakém byly offsety
+    with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as pool:
+        yield from pool.map(fetch_page, offsets)
 
-        results = data.get("results", [])
-        all_deals.extend(results)
 
-        pages += 1
-        if DEBUG_MAX_PAGES and pages >= DEBUG_MAX_PAGES:
-            break
+# ===== Agregace a Excel =====
+def sum_amounts_by_owner_and_stage_id(pages: Iterable[List[dict]]) -> pd.DataFrame:
+    """
+    Součet 'amount' podle surových (hubspot_owner_id, dealstage). Stránky se
+    konzumují průběžně – z každého dealu zůstanou jen tři hodnoty, celý JSON
+    stránky se hned zahodí.
+    """
+    records = [
+        (props.get("hubspot_owner_id"), props.get("dealstage"), props.get("amount"))
+        for page in pages
+        for props in (d.get("properties", {}) or {} for d in page)
+    ]
+    df = pd.DataFrame(records, columns=["owner", "stage", "amount"])
 
-        after = data.get("paging", {}).get("next", {}).get("after")
-        if not after:
-            break
+    # vektorově: nečíselný / prázdný amount = 0
+    df["amount"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
 
-    return all_deals
+    # sort=False drží pořadí prvního výskytu (= pořadí listů a řádků v Excelu)
+    return df.groupby(["owner", "stage"], sort=False, dropna=False)["amount"].sum().reset_index()
 
 
-# ===== Agregace a Excel =====
 def aggregate_amounts_by_owner_and_stage(
-    deals: List[dict],
+    id_sums: pd.DataFrame,
     owners_map: Dict[str, str],
     stage_label_map: Dict[str, str],
 ) -> Dict[str, Dict[str, float]]:
-    data: Dict[str, Dict[str, float]] = {}
-    for d in deals:
-        props = d.get("properties", {}) or {}
-        stage_id = props.get("dealstage")
-        stage_label = stage_label_map.get(stage_id, "Unknown stage")
-
-        amount = props.get("amount")
-        try:
-            val = float(amount) if amount not in (None, "") else 0.0
-        except ValueError:
-            val = 0.0
-
-        owner_id = props.get("hubspot_owner_id")
-        owner_name = owners_map.get(str(owner_id), "Unassigned")
-
-        data.setdefault(owner_name, {}).setdefault(stage_label, 0.0)
-        data[owner_name][stage_label] += val
+    # Labely se mapují až na malý výsledek podle ID. Víc ID může mít stejný label
+    # (stejně pojmenované stage v různých pipelines, chybějící owner), proto druhý
+    # groupby už nad labely.
+    sums = id_sums.copy()
+    sums["owner"] = sums["owner"].astype(str).map(owners_map).fillna("Unassigned")
+    sums["stage"] = sums["stage"].map(stage_label_map).fillna("Unknown stage")
+    sums = sums.groupby(["owner", "stage"], sort=False)["amount"].sum()
 
+    data: Dict[str, Dict[str, float]] = {}
+    for (owner_name, stage_label), val in sums.items():
+        data.setdefault(owner_name, {})[stage_label] = float(val)
     return data
 
 
@@ -226,16 +307,122 @@ def previous_week_label(now_local: datetime) -> Tuple[str, datetime, datetime]:
     return label, monday_prev, sunday_prev
 
 
-def ensure_sheet(
-    wb: openpyxl.Workbook, title: str
-) -> openpyxl.worksheet.worksheet.Worksheet:
-    safe = title
+def sheet_title(owner_name: str) -> str:
+    safe = owner_name
     for ch in r"\/?*[]:":
         safe = safe.replace(ch, " ")
     safe = safe.strip() or "Unassigned"
-    if safe in wb.sheetnames:
-        return wb[safe]
-    return wb.create_sheet(title=safe[:31])
+    return safe[:31]
+
+
+def snapshot_row_cells(ws, row: list, header: bool = False) -> List[WriteOnlyCell]:
+    """Řádek pro write_only list: header tučně, částky s formátem AMOUNT_FORMAT."""
+    cells = []
+    for i, value in enumerate(row):
+        cell = WriteOnlyCell(ws, value=value)
+        if header:
+            cell.font = HEADER_FONT
+        elif i > 0 and isinstance(value, (int, float)):
+            cell.number_format = AMOUNT_FORMAT
+        cells.append(cell)
+    return cells
+
+
+def set_cell(row: list, col: int, value):
+    if len(row) <= col:
+        row.extend([None] * (col + 1 - len(row)))
+    row[col] = value
+
+
+def write_owner_sheet(
+    ws,
+    rows: Iterator[tuple],
+    week_label: str,
+    stage_sums: Dict[str, float],
+    default_stage_order: List[str],
+    allow_duplicates: bool,
+):
+    """
+    Streamuje řádky existujícího listu (rows) do write_only listu ws a cestou
+    doplní týdenní sloupec. V paměti je vždy jen jeden řádek.
+    """
+    headers = list(next(rows, None) or ["Stage"])
+    headers[0] = "Stage"
+
+    if allow_duplicates:
+        # duplicity jen pokud si to vyloženě zapneš
+        headers.append(make_unique_week_label(headers, week_label))
+        week_col = len(headers) - 1
+    else:
+        # DEFAULT: neduplikovat – přepiš existující týdenní sloupec
+        header_pos = {h: i for i, h in enumerate(headers) if h}
+        week_col = header_pos.get(week_label)
+        if week_col is None:
+            headers.append(week_label)
+            week_col = len(headers) - 1
+
+    ws.append(snapshot_row_cells(ws, headers, header=True))
+
+    seen = set()
+    for row in rows:
+        row = list(row)
+        label = row[0] if row else None
+        if label:
+            seen.add(label)
+            if label in stage_sums:
+                set_cell(row, week_col, stage_sums[label])
+        ws.append(snapshot_row_cells(ws, row))
+
+    # stage, které v listu ještě nejsou: nejdřív pořadí z pipeline, pak zbytek
+    for stage in [*default_stage_order, *stage_sums.keys()]:
+        if stage in seen:
+            continue
+        seen.add(stage)
+        row = [stage]
+        if stage in stage_sums:
+            set_cell(row, week_col, stage_sums[stage])
+        ws.append(snapshot_row_cells(ws, row))
+
+
+def snapshot_unchanged(
+    excel_path: Path,
+    week_label: str,
+    pending: Dict[str, Dict[str, float]],
+    default_stage_order: List[str],
+) -> bool:
+    """
+    True, pokud soubor už obsahuje sloupec week_label se stejnými částkami
+    a všemi stage pro všechny ownery – přepis by nic nezměnil (opakovaný běh).
+    """
+    if not excel_path.exists():
+        return False
+
+    src = openpyxl.load_workbook(excel_path, read_only=True)
+    try:
+        for title, stage_sums in pending.items():
+            if title not in src.sheetnames:
+                return False
+            rows = src[title].iter_rows(values_only=True)
+            headers = next(rows, None)
+            if not headers or headers[0] != "Stage" or week_label not in headers:
+                return False
+            week_col = headers.index(week_label)
+
+            seen = set()
+            for row in rows:
+                label = row[0] if row else None
+                if not label:
+                    continue
+                seen.add(label)
+                if label in stage_sums:
+                    value = row[week_col] if len(row) > week_col else None
+                    if value != stage_sums[label]:
+                        return False
+            if not seen.issuperset(default_stage_order) or not seen.issuperset(stage_sums):
+                return False
+    finally:
+        src.close()
+    return True
 
 
 def write_snapshot_to_excel(
@@ -243,63 +430,51 @@ def write_snapshot_to_excel(
     week_label: str,
     data_by_owner: Dict[str, Dict[str, float]],
     default_stage_order: List[str],
-):
+) -> bool:
+    """Zapíše snapshot; vrací False, pokud se soubor nepřepisoval (beze změny)."""
     excel_path.parent.mkdir(parents=True, exist_ok=True)
 
-    if excel_path.exists():
-        wb = openpyxl.load_workbook(excel_path)
-    else:
-        wb = openpyxl.Workbook()
-        if "Sheet" in wb.sheetnames and len(wb.sheetnames) == 1:
-            del wb["Sheet"]
-
     allow_duplicates = env_bool("ALLOW_DUPLICATE_WEEK_COLUMNS", default=False)
 
+    pending: Dict[str, Dict[str, float]] = {}
     for owner_name, stage_sums in data_by_owner.items():
-        ws = ensure_sheet(wb, owner_name)
+        pending.setdefault(sheet_title(owner_name), {}).update(stage_sums)
 
-        if ws.max_row < 1 or ws["A1"].value != "Stage":
-            ws["A1"] = "Stage"
+    if not allow_duplicates and snapshot_unchanged(
+        excel_path, week_label, pending, default_stage_order
+    ):
+        return False
 
-        headers = [ws.cell(row=1, column=c).value for c in range(1, ws.max_column + 1)]
-
-        if allow_duplicates:
-            # duplicity jen pokud si to vyloženě zapneš
-            unique_label = make_unique_week_label(headers, week_label)
-            week_col = ws.max_column + 1
-            ws.cell(row=1, column=week_col, value=unique_label)
-        else:
-            # DEFAULT: neduplikovat – přepiš existující týdenní sloupec
-            if week_label in headers:
-                week_col = headers.index(week_label) + 1
-            else:
-                week_col = ws.max_column + 1
-                ws.cell(row=1, column=week_col, value=week_label)
-
-        existing_rows: Dict[str, int] = {}
-        for r in range(2, ws.max_row + 1):
-            lbl = ws.cell(row=r, column=1).value
-            if lbl:
-                existing_rows[lbl] = r
-
-        next_row = ws.max_row + 1
-        for stage in default_stage_order:
-            if stage not in existing_rows:
-                ws.cell(row=next_row, column=1, value=stage)
-                existing_rows[stage] = next_row
-                next_row += 1
-
-        for stage in stage_sums.keys():
-            if stage not in existing_rows:
-                ws.cell(row=next_row, column=1, value=stage)
-                existing_rows[stage] = next_row
-                next_row += 1
-
-        for stage, amount_sum in stage_sums.items():
-            r = existing_rows[stage]
-            ws.cell(row=r, column=week_col, value=amount_sum)
-
-    wb.save(excel_path)
+    # Starý soubor se čte read_only (streamovaně) a nový se zapisuje write_only
+    # list po listu, řádek po řádku – paměť neroste s počtem týdnů v historii.
+    wb = openpyxl.Workbook(write_only=True)
+    if excel_path.exists():
+        src = openpyxl.load_workbook(excel_path, read_only=True)
+        try:
+            for src_ws in src.worksheets:
+                ws = wb.create_sheet(title=src_ws.title)
+                rows = src_ws.iter_rows(values_only=True)
+                stage_sums = pending.pop(src_ws.title, None)
+                if stage_sums is None:
+                    for i, row in enumerate(rows):
+                        ws.append(snapshot_row_cells(ws, list(row), header=(i == 0)))
+                else:
+                    write_owner_sheet(
+                        ws, rows, week_label, stage_sums, default_stage_order, allow_duplicates
+                    )
+        finally:
+            src.close()
+
+    for title, stage_sums in pending.items():
+        ws = wb.create_sheet(title=title)
+        write_owner_sheet(
+            ws, iter(()), week_label, stage_sums, default_stage_order, allow_duplicates
+        )
+
+    tmp_path = excel_path.with_suffix(".tmp.xlsx")
+    wb.save(tmp_path)
+    os.replace(tmp_path, excel_path)
+    return True
 
 
 # ===== Hlavní běh =====
@@ -309,13 +484,19 @@ def main():
     week_label, _, _ = previous_week_label(now_local)
     cutoff_ms = iso_to_epoch_ms(CUTOFF_DATE_ISO)
 
-    owners_map = get_all_owners(token)
-    stage_label_map, default_stage_order = get_stage_label_map(token)
-    deals = fetch_deals(token, cutoff_ms)
-    data_by_owner = aggregate_amounts_by_owner_and_stage(deals, owners_map, stage_label_map)
+    session = make_session(token)
+    # owners a pipelines běží na poolu, mezitím se průběžně sčítají stránky dealů
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        owners_future = pool.submit(get_all_owners, session)
+        stages_future = pool.submit(get_stage_label_map, session)
+        id_sums = sum_amounts_by_owner_and_stage_id(iter_deal_pages(session, cutoff_ms))
+        owners_map = owners_future.result()
+        stage_label_map, default_stage_order = stages_future.result()
+    data_by_owner = aggregate_amounts_by_owner_and_stage(id_sums, owners_map, stage_label_map)
 
     print("Ukládám do:", EXCEL_PATH)
-    write_snapshot_to_excel(EXCEL_PATH, week_label, data_by_owner, default_stage_order)
+    if not write_snapshot_to_excel(EXCEL_PATH, week_label, data_by_owner, default_stage_order):
+        print("Snapshot pro tento týden už je zapsaný se stejnými hodnotami – soubor beze změny.")
 
     print(f"Hotovo. Zapsán snapshot pro {week_label}")
     print(f"Soubor: {EXCEL_PATH}")
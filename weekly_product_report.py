@@ -1,9 +1,14 @@
 import os
+import re
+import json
+import random
 import time
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple, Iterable
 
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from openpyxl import Workbook, load_workbook
 from openpyxl.styles import Font, Alignment, PatternFill
@@ -21,6 +26,11 @@ from openpyxl.worksheet.table import Table, TableStyleInfo
 from openpyxl.worksheet.datavalidation import DataValidation
 from dotenv import load_dotenv
 
+try:
+    import orjson  # rychlejší (de)serializace JSON; bez něj fallback na stdlib
+except ImportError:
+    orjson = None
+
 # =========================
 # CONFIG
 # =========================
@@ -31,6 +41,10 @@ ENV_PATH = PROJECT_DIR / ".env"      # lokálně může existovat, v GitHubu nev
 OUTPUT_DIR = Path("outputs")         # GitHub-friendly
 
 BASE_URL = "https://api.hubapi.com"
+HTTP_WORKERS = 8                     # souběžné batch requesty (HubSpot limit ~100 req / 10 s)
+META_CACHE_TTL = 24 * 3600            # property / pipelines / owners se mění zřídka
+META_CACHE_VERSION = 1               # zvýšit při změně tvaru cachovaných dat
+MULTICHECKBOX_SEP = re.compile(r"\s*;\s*")   # oddělovač hodnot multi-checkboxu vč. okolních mezer
 
 DEFAULT_PRODUCTS = ["Tapix", "EcoTrack", "ATM Nearby", "Labelling", "OpenData", "Subscription"]
 
@@ -199,23 +213,50 @@ def attribution_split_factor(product_set, target_product) -> float:
 # HELPERS
 # =========================
 
-def hubspot_request(token: str, method: str, path: str, *, params=None, json=None, retries: int = 5):
+def _make_session() -> requests.Session:
+    """Sdílená session: keep-alive spojení (TCP/TLS) se znovu používá napříč requesty i vlákny."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+    return session
+
+
+SESSION = _make_session()
+
+
+def _retry_delay(r: requests.Response, attempt: int) -> float:
+    """Retry-After z HubSpotu má přednost před 2**attempt; jitter proti souběžným retry."""
+    try:
+        delay = float(r.headers["Retry-After"])
+    except (KeyError, ValueError):
+        delay = min(2 ** attempt, 20)
+    return delay + random.uniform(0, 1.0)
+
+
+def hubspot_request(token: str, method: str, path: str, *, params=None, json=None, retries: int = 5,
+                    session: Optional[requests.Session] = None):
     url = f"{BASE_URL}{path}"
     headers = {"authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    session = session or SESSION
+
+    data = None
+    if json is not None and orjson is not None:
+        # payload se serializuje jen jednou (ne při každém retry) a rovnou do bytes
+        data, json = orjson.dumps(json), None
 
     last = None
     for attempt in range(retries):
-        r = requests.request(method, url, headers=headers, params=params, json=json, timeout=60)
+        r = session.request(method, url, headers=headers, params=params, json=json, data=data, timeout=60)
         last = r
 
         if r.status_code in (429, 500, 502, 503, 504):
-            time.sleep(min(2 ** attempt, 20))
+            time.sleep(_retry_delay(r, attempt))
             continue
 
         r.raise_for_status()
         # některé endpointy vrací [] (list), jiné dict
-        if r.text and r.text.strip():
-            return r.json()
+        # r.content = bytes, bez dekódování do str jako u r.text
+        if r.content and r.content.strip():
+            return orjson.loads(r.content) if orjson is not None else r.json()
         return {}
 
     if last is not None:
@@ -241,6 +282,12 @@ def chunked(items: List[str], size: int) -> Iterable[List[str]]:
 
 
 def ensure_sheet_headers(ws):
+    # hlavička už je (typicky každý běh nad existujícím souborem) -> nestylovat znovu
+    if ws.freeze_panes == "A2":
+        first = next(ws.iter_rows(min_row=1, max_row=1, max_col=len(SHEET_HEADERS), values_only=True), ())
+        if list(first) == SHEET_HEADERS:
+            return
+
     for c, h in enumerate(SHEET_HEADERS, start=1):
         cell = ws.cell(row=1, column=c, value=h)
         cell.font = HEADER_FONT
@@ -251,8 +298,8 @@ def ensure_sheet_headers(ws):
     ws.sheet_view.showGridLines = False
 
 
-def create_new_workbook(path: str, products: List[str]) -> Workbook:
-    """Vytvoří nový workbook (uživatel smaže starý)."""
+def create_new_workbook(products: List[str]) -> Workbook:
+    """Vytvoří nový workbook (uživatel smaže starý). Uloží ho až main()."""
     wb = Workbook()
     ws = wb.active
     ws.title = "Summary"
@@ -262,13 +309,42 @@ def create_new_workbook(path: str, products: List[str]) -> Workbook:
 
     for p in products:
         sh = wb.create_sheet(title=excel_safe_sheet_name(p))
-        sh.append(SHEET_HEADERS)
         ensure_sheet_headers(sh)
 
-    wb.save(path)
     return wb
 
 
+def cached_meta(key: str, loader, ttl_seconds: int = META_CACHE_TTL):
+    """
+    Výsledek loader() z OUTPUT_DIR/.product_meta_{key}_cache.json, pokud je cache mladší než ttl_seconds
+    a má aktuální META_CACHE_VERSION; jinak zavolá loader() a cache atomicky přepíše.
+    """
+    # vlastní prefix: .owners_cache.json / .pipelines_cache.json patří weekly reportům (jiný tvar dat)
+    path = OUTPUT_DIR / f".product_meta_{key}_cache.json"
+    try:
+        if time.time() - path.stat().st_mtime < ttl_seconds:
+            raw = path.read_bytes()
+            cached = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            if isinstance(cached, dict) and cached.get("version") == META_CACHE_VERSION:
+                return cached["data"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    data = loader()
+    payload = {"version": META_CACHE_VERSION, "data": data}
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        if orjson is not None:
+            tmp.write_bytes(orjson.dumps(payload))
+        else:
+            tmp.write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+    except OSError:
+        pass  # cache je jen optimalizace
+    return data
+
+
 def find_product_property_name(token: str, label: str, explicit_name: Optional[str]) -> str:
     if explicit_name:
         return explicit_name
@@ -305,7 +381,7 @@ def get_pipelines_map(token: str) -> Tuple[Dict[str, str], Dict[str, str]]:
     return pipeline_label, stage_label
 
 
-def list_all_deals(token: str, properties: List[str]) -> List[dict]:
+def list_all_deals(token: str, properties: List[str], associations: Optional[List[str]] = None) -> List[dict]:
     deals = []
     after = None
 
@@ -315,11 +391,19 @@ def list_all_deals(token: str, properties: List[str]) -> List[dict]:
             "properties": ",".join(properties),
             "archived": "false",
         }
+        if associations:
+            params["associations"] = ",".join(associations)
         if after is not None:
             params["after"] = after
 
         page = hubspot_request(token, "GET", "/crm/v3/objects/deals", params=params)
-        deals.extend(page.get("results", []))
+        # drží se jen to, co se dál čte (id + properties, případně associations); createdAt,
+        # updatedAt, archived, url… z každého záznamu se hned zahodí spolu se stránkou
+        for rec in page.get("results", []):
+            deal = {"id": rec.get("id"), "properties": rec.get("properties") or {}}
+            if associations:
+                deal["associations"] = rec.get("associations") or {}
+            deals.append(deal)
 
         nxt = (page.get("paging") or {}).get("next") or {}
         after = nxt.get("after")
@@ -329,15 +413,9 @@ def list_all_deals(token: str, properties: List[str]) -> List[dict]:
     return deals
 
 
-def split_multicheckbox(value: Optional[str]) -> List[str]:
-    if not value:
-        return []
-    return [p.strip() for p in value.split(";") if p.strip()]
-
-
-def get_owners_map(token: str) -> Dict[str, Dict[str, str]]:
+def get_owners_map(token: str) -> Tuple[Dict[str, str], Dict[str, str]]:
     """
-    owner_id -> {"name": "...", "email": "..."}
+    (owner_id -> name, owner_id -> email)
     Zkouší v3 endpoint; fallback legacy v2.
     """
     candidate_paths = ["/crm/v3/owners", "/owners/v2/owners"]
@@ -356,7 +434,8 @@ def get_owners_map(token: str) -> Dict[str, Dict[str, str]]:
 
     results = data.get("results", []) if isinstance(data, dict) else data
 
-    owners: Dict[str, Dict[str, str]] = {}
+    names: Dict[str, str] = {}
+    emails: Dict[str, str] = {}
     for o in results:
         oid = str(o.get("id") or "")
         if not oid:
@@ -365,9 +444,40 @@ def get_owners_map(token: str) -> Dict[str, Dict[str, str]]:
         last = (o.get("lastName") or "").strip()
         email = (o.get("email") or "").strip()
         name = (f"{first} {last}").strip() or email or oid
-        owners[oid] = {"name": name, "email": email}
+        names[oid] = name
+        emails[oid] = email
+
+    return names, emails
+
+
+def primary_company_from_associations(deals: List[dict]) -> Tuple[Dict[str, str], List[str]]:
+    """
+    deal_id -> primary_company_id (nebo první associated) z associations=companies
+    vrácených list_all_deals. Primary asociace má v v3 typ "deal_to_company".
+    Druhý prvek = deal_ids se stránkovaným (neúplným) seznamem companies,
+    ty je potřeba dočíst přes batch_read_deal_company_primary.
+    """
+    result: Dict[str, str] = {}
+    incomplete: List[str] = []
+    for d in deals:
+        deal_id = str(d.get("id"))
+        companies = (d.get("associations") or {}).get("companies") or {}
+        if companies.get("paging"):
+            incomplete.append(deal_id)
+            continue
 
-    return owners
+        primary_company_id = None
+        fallback_first = None
+        for a in companies.get("results") or []:
+            cid = str(a.get("id"))
+            if not fallback_first:
+                fallback_first = cid
+            if a.get("type") == "deal_to_company":
+                primary_company_id = cid
+                break
+
+        result[deal_id] = primary_company_id or fallback_first or ""
+    return result, incomplete
 
 
 def batch_read_deal_company_primary(token: str, deal_ids: List[str]) -> Dict[str, str]:
@@ -383,10 +493,8 @@ def batch_read_deal_company_primary(token: str, deal_ids: List[str]) -> Dict[str
         "/crm/v4/associations/deals/company/batch/read",
     ]
 
-    result: Dict[str, str] = {}
-
-    for batch in chunked(deal_ids, 1000):
-        payload = {"inputs": [{"id": str(did)} for did in batch]}
+    def fetch_batch(batch: List[str]) -> Dict[str, str]:
+        payload = {"inputs": [{"id": did} for did in batch]}
 
         last_err = None
         data = None
@@ -401,6 +509,7 @@ def batch_read_deal_company_primary(token: str, deal_ids: List[str]) -> Dict[str
         if data is None:
             raise RuntimeError(f"Nepodařilo se stáhnout associations deal->company. Poslední chyba: {last_err}")
 
+        part: Dict[str, str] = {}
         for rec in data.get("results", []):
             deal_id = str((rec.get("from") or {}).get("id"))
             tos = rec.get("to") or []
@@ -408,18 +517,29 @@ def batch_read_deal_company_primary(token: str, deal_ids: List[str]) -> Dict[str
             primary_company_id = None
             fallback_first = None
 
+            # str() jen pro vybrané id; lower() jen když label není přímo "Primary"
             for t in tos:
-                cid = str(t.get("toObjectId"))
-                if not fallback_first:
+                cid = t.get("toObjectId")
+                if fallback_first is None:
                     fallback_first = cid
 
-                assoc_types = t.get("associationTypes") or []
-                if any((a.get("label") or "").lower() == "primary" for a in assoc_types):
-                    primary_company_id = cid
+                for a in t.get("associationTypes") or ():
+                    label = a.get("label")
+                    if label == "Primary" or (label and label.lower() == "primary"):
+                        primary_company_id = cid
+                        break
+                if primary_company_id is not None:
                     break
 
-            result[deal_id] = primary_company_id or fallback_first or ""
+            company_id = primary_company_id if primary_company_id is not None else fallback_first
+            part[deal_id] = str(company_id) if company_id is not None else ""
+        return part
 
+    # batche jsou nezávislé -> paralelně přes sdílenou session
+    result: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+        for part in pool.map(fetch_batch, list(chunked(deal_ids, 1000))):
+            result.update(part)
     return result
 
 
@@ -428,10 +548,9 @@ def batch_read_company_names(token: str, company_ids: List[str]) -> Dict[str, st
     if not company_ids:
         return {}
 
-    names: Dict[str, str] = {}
-    for batch in chunked(company_ids, 100):
+    def fetch_batch(batch: List[str]) -> Dict[str, str]:
         payload = {
-            "inputs": [{"id": str(cid)} for cid in batch],
+            "inputs": [{"id": cid} for cid in batch],
             "properties": ["name"],
         }
         data = hubspot_request(
@@ -441,10 +560,17 @@ def batch_read_company_names(token: str, company_ids: List[str]) -> Dict[str, st
             params={"archived": "false"},
             json=payload,
         )
+        part: Dict[str, str] = {}
         for r in data.get("results", []):
             cid = str(r.get("id"))
             props = r.get("properties") or {}
-            names[cid] = props.get("name") or ""
+            part[cid] = props.get("name") or ""
+        return part
+
+    names: Dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=HTTP_WORKERS) as pool:
+        for part in pool.map(fetch_batch, list(chunked(company_ids, 100))):
+            names.update(part)
     return names
 
 
@@ -458,71 +584,59 @@ def build_rows(
     products_interest: List[str],
     deal_to_company_id: Dict[str, str],
     company_id_to_name: Dict[str, str],
-    owners_map: Dict[str, Dict[str, str]],
-) -> Dict[str, List[List]]:
+    owner_names: Dict[str, str],
+    owner_emails: Dict[str, str],
+) -> Dict[str, pd.DataFrame]:
+    """product -> DataFrame řádků snapshotu (sloupce = SHEET_HEADERS, chybějící hodnoty None)."""
     want = {p.lower(): p for p in products_interest}
-    rows_by_product: Dict[str, List[List]] = {p: [] for p in products_interest}
+    rows_by_product: Dict[str, pd.DataFrame] = {
+        p: pd.DataFrame(columns=SHEET_HEADERS) for p in products_interest
+    }
+    if not deals:
+        return rows_by_product
 
-    # dedupe per product per snapshot: (product, deal_id)
-    seen = set()
+    cols = [
+        "dealname", "amount", "closedate", "createdate", "hs_lastmodifieddate",
+        "pipeline", "dealstage", "hubspot_owner_id", product_property_name,
+    ]
+    df = pd.DataFrame.from_records([d.get("properties") or {} for d in deals], columns=cols)
+    df["deal_id"] = [str(d.get("id")) for d in deals]
 
-    for d in deals:
-        deal_id = str(d.get("id"))
-        props = d.get("properties") or {}
-
-        dealname = props.get("dealname")
-        amount = props.get("amount")
-        closedate = props.get("closedate")
-        createdate = props.get("createdate")
-        lastmod = props.get("hs_lastmodifieddate")
-
-        pipeline_id = props.get("pipeline")
-        stage_id = props.get("dealstage")
-        pipeline_lbl = pipeline_label.get(pipeline_id, pipeline_id)
-        stage_lbl = stage_label.get(stage_id, stage_id)
-
-        company_id = deal_to_company_id.get(deal_id, "") or ""
-        company_name = company_id_to_name.get(company_id, "") if company_id else ""
-
-        owner_id = str(props.get("hubspot_owner_id") or "")
-        owner_name = owners_map.get(owner_id, {}).get("name", "") if owner_id else ""
-        owner_email = owners_map.get(owner_id, {}).get("email", "") if owner_id else ""
-
-        product_raw = props.get(product_property_name)
-        product_values = split_multicheckbox(product_raw)
-        product_labels = [opt_map.get(v, v) for v in product_values]
-
-        for pl in product_labels:
-            key = (pl or "").strip().lower()
-            if key in want:
-                sheet_product = want[key]
-                if (sheet_product, deal_id) in seen:
-                    continue
-                seen.add((sheet_product, deal_id))
-
-                deal_url = f"https://app.hubspot.com/contacts/deal/{deal_id}"
-
-                rows_by_product[sheet_product].append([
-                    snapshot_week_start,
-                    deal_id,
-                    dealname,
-                    company_id,
-                    company_name,
-                    sheet_product,
-                    product_raw,
-                    pipeline_id,
-                    pipeline_lbl,
-                    stage_id,
-                    stage_lbl,
-                    amount,
-                    closedate,
-                    createdate,
-                    lastmod,
-                    owner_id,
-                    owner_name,
-                    owner_email,
-                    deal_url
-                ])
+    # jeden řádek na (deal, hodnota multi-checkboxu) -> label -> sheet produktu
+    df["product_raw"] = df[product_property_name]
+    df["_value"] = df[product_property_name].fillna("").astype(str).str.strip().str.split(MULTICHECKBOX_SEP)
+    df = df.explode("_value")
+    df = df[df["_value"] != ""]
+    product_lbl = df["_value"].map(opt_map).fillna(df["_value"])
+    df["sheet_product"] = product_lbl.astype(str).str.strip().str.lower().map(want)
+
+    # dedupe per product per snapshot: (product, deal_id)
+    df = df.dropna(subset=["sheet_product"]).drop_duplicates(["sheet_product", "deal_id"])
+    if df.empty:
+        return rows_by_product
+
+    df["snapshot_week_start"] = snapshot_week_start
+    df["amount"] = pd.to_numeric(df["amount"], errors="coerce")   # do sheetu jako číslo
+    df["pipeline_label"] = df["pipeline"].map(pipeline_label).fillna(df["pipeline"])
+    df["stage_label"] = df["dealstage"].map(stage_label).fillna(df["dealstage"])
+    df["company_id"] = df["deal_id"].map(deal_to_company_id).fillna("")
+    df["company_name"] = df["company_id"].map(company_id_to_name).fillna("")
+    df["owner_id"] = df["hubspot_owner_id"].fillna("").astype(str)
+    df["owner_name"] = df["owner_id"].map(owner_names).fillna("")
+    df["owner_email"] = df["owner_id"].map(owner_emails).fillna("")
+    df["deal_url"] = "https://app.hubspot.com/contacts/deal/" + df["deal_id"]
+
+    out = df[[
+        "snapshot_week_start", "deal_id", "dealname", "company_id", "company_name",
+        "sheet_product", "product_raw", "pipeline", "pipeline_label", "dealstage", "stage_label",
+        "amount", "closedate", "createdate", "hs_lastmodifieddate",
+        "owner_id", "owner_name", "owner_email", "deal_url",
+    ]].astype(object)
+    out = out.where(out.notna(), None)
+    out.columns = SHEET_HEADERS
+
+    for product, g in out.groupby("product_option", sort=False):
+        rows_by_product[product] = g.reset_index(drop=True)
 
     return rows_by_product
 
@@ -543,17 +657,17 @@ def snapshot_exists(ws, snapshot_week_start: str) -> bool:
     return False
 
 
-def replace_rows_for_snapshot(ws, rows: List[List], snapshot_week_start: str):
+def replace_rows_for_snapshot(ws, rows: pd.DataFrame, snapshot_week_start: str):
     """
     NOVÉ CHOVÁNÍ (doplňování po týdnech):
     - Pokud už snapshot pro tento týden existuje, NIC nepřepisuj (žádné mazání).
     - Pokud neexistuje, pouze přidej nové řádky (append).
     """
-    if snapshot_exists(ws, snapshot_week_start):
-        # týden už je zapsaný -> nech ho být (doplňování po týdnech)
+    if rows.empty or snapshot_exists(ws, snapshot_week_start):
+        # není co psát / týden už je zapsaný -> nech ho být (doplňování po týdnech)
         return
 
-    for row in rows:
+    for row in rows.itertuples(index=False, name=None):
         ws.append(row)
 
 
@@ -562,30 +676,33 @@ def replace_rows_for_snapshot(ws, rows: List[List], snapshot_week_start: str):
 # =========================
 
 def read_all_product_sheets(wb, products: List[str]) -> pd.DataFrame:
-    frames = []
+    # řádky všech sheetů rovnou do jednoho seznamu -> jeden DataFrame bez pd.concat;
+    # max_col ořízne/doplní každý řádek na šířku SHEET_HEADERS
+    data = []
     for p in products:
         name = excel_safe_sheet_name(p)
         if name not in wb.sheetnames:
             continue
         ws = wb[name]
-        data = []
-        for r in ws.iter_rows(min_row=2, values_only=True):
-            if not r or not r[0]:
-                continue
-            r = list(r)
-            if len(r) < len(SHEET_HEADERS):
-                r += [None] * (len(SHEET_HEADERS) - len(r))
-            data.append(r[:len(SHEET_HEADERS)])
-        if data:
-            frames.append(pd.DataFrame(data, columns=SHEET_HEADERS))
-
-    if not frames:
-        return pd.DataFrame(columns=SHEET_HEADERS)
-    return pd.concat(frames, ignore_index=True)
-
-
-def rewrite_summary_sheet(wb, products: List[str]):
-    df = read_all_product_sheets(wb, products)
+        data.extend(
+            r for r in ws.iter_rows(min_row=2, max_col=len(SHEET_HEADERS), values_only=True)
+            if r and r[0]
+        )
+
+    return pd.DataFrame(data, columns=SHEET_HEADERS)
+
+
+def amount_to_float(amount: pd.Series) -> pd.Series:
+    """amount -> float, prázdné/nečíselné = 0.0. build_rows zapisuje amount už jako číslo,
+    pomalé pd.to_numeric přes object sloupec je jen pro starší snapshoty s textovým amount."""
+    if not pd.api.types.is_numeric_dtype(amount):
+        amount = pd.to_numeric(amount, errors="coerce")
+    return amount.fillna(0.0).astype(float)
+
+
+def rewrite_summary_sheet(wb, products: List[str], df: Optional[pd.DataFrame] = None):
+    if df is None:
+        df = read_all_product_sheets(wb, products)
     ws = wb["Summary"]
     ws.delete_rows(1, ws.max_row)
 
@@ -598,14 +715,18 @@ def rewrite_summary_sheet(wb, products: List[str]):
         return
 
     # typing / cleanup
+    df = df.copy()
     df["snapshot_week_start"] = df["snapshot_week_start"].astype(str)
     df["product_option"] = df["product_option"].astype(str)
     df["pipeline_label"] = df["pipeline_label"].astype(str)
     df["dealstage_label"] = df["dealstage_label"].astype(str)
     df["owner_name"] = df["owner_name"].fillna("").astype(str)
-    df["amount_num"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
+    df["amount_num"] = amount_to_float(df["amount"])
 
     weeks = sorted(df["snapshot_week_start"].unique().tolist())
+    # groupby nad kódy kategorií místo hashování stringů; řadí se jen malý tidy výstup
+    for col in ("snapshot_week_start", "product_option", "owner_name", "pipeline_label", "dealstage_label"):
+        df[col] = df[col].astype("category")
     prod_order = products[:]
 
     # -------------------------
@@ -627,16 +748,21 @@ def rewrite_summary_sheet(wb, products: List[str]):
         ws.column_dimensions[get_column_letter(i)].width = 14
 
     counts = (
-        df.groupby(["product_option", "snapshot_week_start"])["deal_id"]
-          .nunique()
+        df.drop_duplicates(["product_option", "snapshot_week_start", "deal_id"])
+          .groupby(["product_option", "snapshot_week_start"], sort=False, observed=True)
+          .size()
           .reset_index(name="deal_count")
     )
-    count_pivot = counts.pivot(index="product_option", columns="snapshot_week_start", values="deal_count").fillna(0).astype(int)
+    count_pivot = (
+        counts.pivot(index="product_option", columns="snapshot_week_start", values="deal_count")
+              .reindex(index=prod_order, columns=weeks)
+              .fillna(0)
+              .astype(int)
+    )
 
-    for r_i, p in enumerate(prod_order, start=start_row + 1):
+    for r_i, (p, vals) in enumerate(zip(prod_order, count_pivot.values.tolist()), start=start_row + 1):
         ws.cell(row=r_i, column=1, value=p)
-        for c_i, w in enumerate(weeks, start=2):
-            val = int(count_pivot.loc[p, w]) if (p in count_pivot.index and w in count_pivot.columns) else 0
+        for c_i, val in enumerate(vals, start=2):
             ws.cell(row=r_i, column=c_i, value=val)
 
     # -------------------------
@@ -657,16 +783,20 @@ def rewrite_summary_sheet(wb, products: List[str]):
         c.alignment = WRAP
 
     sums = (
-        df.groupby(["product_option", "snapshot_week_start"])["amount_num"]
+        df.groupby(["product_option", "snapshot_week_start"], sort=False, observed=True)["amount_num"]
           .sum()
           .reset_index(name="amount_sum")
     )
-    sum_pivot = sums.pivot(index="product_option", columns="snapshot_week_start", values="amount_sum").fillna(0.0)
+    sum_pivot = (
+        sums.pivot(index="product_option", columns="snapshot_week_start", values="amount_sum")
+            .reindex(index=prod_order, columns=weeks)
+            .fillna(0.0)
+            .astype(float)
+    )
 
-    for r_i, p in enumerate(prod_order, start=start_row2 + 1):
+    for r_i, (p, vals) in enumerate(zip(prod_order, sum_pivot.values.tolist()), start=start_row2 + 1):
         ws.cell(row=r_i, column=1, value=p)
-        for c_i, w in enumerate(weeks, start=2):
-            val = float(sum_pivot.loc[p, w]) if (p in sum_pivot.index and w in sum_pivot.columns) else 0.0
+        for c_i, val in enumerate(vals, start=2):
             cell = ws.cell(row=r_i, column=c_i, value=val)
             cell.number_format = "#,##0.00"
 
@@ -693,7 +823,8 @@ def rewrite_summary_sheet(wb, products: List[str]):
         cell.alignment = WRAP
 
     tidy = (
-        df.groupby(["snapshot_week_start", "product_option", "owner_name", "pipeline_label", "dealstage_label"])
+        df.groupby(["snapshot_week_start", "product_option", "owner_name", "pipeline_label", "dealstage_label"],
+                   sort=False, observed=True)
           .agg(deal_count=("deal_id", "nunique"), amount_sum=("amount_num", "sum"))
           .reset_index()
           .rename(columns={"product_option": "product"})
@@ -701,14 +832,14 @@ def rewrite_summary_sheet(wb, products: List[str]):
     )
 
     row = header_row + 1
-    for _, rec in tidy.iterrows():
-        ws.cell(row=row, column=1, value=rec["snapshot_week_start"])
-        ws.cell(row=row, column=2, value=rec["product"])
-        ws.cell(row=row, column=3, value=rec["owner_name"])
-        ws.cell(row=row, column=4, value=rec["pipeline_label"])
-        ws.cell(row=row, column=5, value=rec["dealstage_label"])
-        ws.cell(row=row, column=6, value=int(rec["deal_count"]))
-        c7 = ws.cell(row=row, column=7, value=float(rec["amount_sum"]))
+    for week, product, owner, pipeline, stage, deal_count, amount_sum in tidy[tidy_headers].itertuples(index=False):
+        ws.cell(row=row, column=1, value=week)
+        ws.cell(row=row, column=2, value=product)
+        ws.cell(row=row, column=3, value=owner)
+        ws.cell(row=row, column=4, value=pipeline)
+        ws.cell(row=row, column=5, value=stage)
+        ws.cell(row=row, column=6, value=int(deal_count))
+        c7 = ws.cell(row=row, column=7, value=float(amount_sum))
         c7.number_format = "#,##0.00"
         row += 1
 
@@ -746,10 +877,12 @@ def _ordered_stages_for_pipeline(pipeline_label: str, data_stages) -> List[str]:
     return ordered
 
 
-def build_dashboard(wb, products: List[str]):
+def build_dashboard(wb, products: List[str], df: Optional[pd.DataFrame] = None):
     """Build/refresh the interactive 'Pipeline Dashboard' sheet and its hidden
-    '_cfg' data sheet. Safe to re-run: both sheets are recreated from scratch."""
-    df = read_all_product_sheets(wb, products)
+    '_cfg' data sheet. Safe to re-run: both sheets are recreated from scratch.
+    ``df`` = already-read product sheets (read_all_product_sheets); read if omitted."""
+    if df is None:
+        df = read_all_product_sheets(wb, products)
 
     for nm in ("Pipeline Dashboard", "_cfg"):
         if nm in wb.sheetnames:
@@ -771,7 +904,7 @@ def build_dashboard(wb, products: List[str]):
     df["pipeline_label"] = df["pipeline_label"].astype(str)
     df["dealstage_label"] = df["dealstage_label"].astype(str)
     df["owner_name"] = df["owner_name"].fillna("").astype(str)
-    df["amount_num"] = pd.to_numeric(df["amount"], errors="coerce").fillna(0.0)
+    df["amount_num"] = amount_to_float(df["amount"])
 
     # ---- revenue-attribution split for multi-product deals ----
     # per-product views use the SPLIT amount; "All products" (deduped) uses
@@ -1160,22 +1293,36 @@ def main():
     # ✅ snapshot pro týden = pondělí (týdny jsou správně, neměníme)
     snapshot_week = week_start_iso()
 
-    product_property_name = find_product_property_name(token, product_label, explicit_prop)
-    opt_map = get_product_options_map(token, product_property_name)
-    pipe_lbl, stage_lbl = get_pipelines_map(token)
-    owners_map = get_owners_map(token)
+    # nezávislé lookupy běží na pozadí, zatímco se stahují dealy
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        pipelines_future = pool.submit(cached_meta, "pipelines", lambda: get_pipelines_map(token))
+        owners_future = pool.submit(cached_meta, "owners", lambda: get_owners_map(token))
 
-    properties = [
-        "dealname", "amount", "closedate", "createdate", "hs_lastmodifieddate",
-        "pipeline", "dealstage",
-        "hubspot_owner_id",
-        product_property_name
-    ]
+        product_property_name = explicit_prop or cached_meta(
+            f"product_property_{product_label.strip().lower()}",
+            lambda: find_product_property_name(token, product_label, None),
+        )
+        options_future = pool.submit(
+            cached_meta, f"options_{product_property_name}",
+            lambda: get_product_options_map(token, product_property_name),
+        )
+
+        properties = [
+            "dealname", "amount", "closedate", "createdate", "hs_lastmodifieddate",
+            "pipeline", "dealstage",
+            "hubspot_owner_id",
+            product_property_name
+        ]
+
+        # associations=companies -> deal->company bez samostatného kola batch requestů
+        deals = list_all_deals(token, properties=properties, associations=["companies"])
 
-    deals = list_all_deals(token, properties=properties)
+        opt_map = options_future.result()
+        pipe_lbl, stage_lbl = pipelines_future.result()
+        owner_names, owner_emails = owners_future.result()
 
-    deal_ids = [str(d.get("id")) for d in deals if d.get("id")]
-    deal_to_company = batch_read_deal_company_primary(token, deal_ids)
+    deal_to_company, incomplete_ids = primary_company_from_associations(deals)
+    deal_to_company.update(batch_read_deal_company_primary(token, incomplete_ids))
 
     company_ids = sorted({cid for cid in deal_to_company.values() if cid})
     company_names = batch_read_company_names(token, company_ids)
@@ -1190,12 +1337,13 @@ def main():
         products_interest=products_interest,
         deal_to_company_id=deal_to_company,
         company_id_to_name=company_names,
-        owners_map=owners_map,
+        owner_names=owner_names,
+        owner_emails=owner_emails,
     )
 
     # ✅ vytvoř nový soubor pokud neexistuje
     if not os.path.exists(out_xlsx):
-        wb = create_new_workbook(out_xlsx, products_interest)
+        wb = create_new_workbook(products_interest)
     else:
         wb = load_workbook(out_xlsx)
         if "Summary" not in wb.sheetnames:
@@ -1210,11 +1358,12 @@ def main():
     for product, rows in rows_by_product.items():
         sh_name = excel_safe_sheet_name(product)
         ws = wb[sh_name]
-        ensure_sheet_headers(ws)
         replace_rows_for_snapshot(ws, rows, snapshot_week)
 
-    rewrite_summary_sheet(wb, products_interest)
-    build_dashboard(wb, products_interest)
+    # product sheety se načtou do DataFrame jen jednou pro Summary i dashboard
+    snapshots_df = read_all_product_sheets(wb, products_interest)
+    rewrite_summary_sheet(wb, products_interest, snapshots_df)
+    build_dashboard(wb, products_interest, snapshots_df)
 
     try:
         wb.calculation.fullCalcOnLoad = True